@@ -1,6 +1,16 @@
 import os
+import re
 import sys
 
+INCLUDE_RE = re.compile(r'^[ \t]*#include "([^"]+)"[^\n]*\n?', re.MULTILINE)
+
+# Escape table for C++ string literals (single pass via str.translate)
+CPP_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n"\n"'})
+
+def read_source(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read().decode('utf-8').replace('\r\n', '\n')
+
 def process_includes(filepath, processed_files=None):
     if processed_files is None:
         processed_files = set()
@@ -14,21 +24,13 @@ def process_includes(filepath, processed_files=None):
         print(f"Warning: File not found: {filepath}")
         return f"// File not found: {filepath}\n"
 
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-    
-    new_content = []
     shader_dir = os.path.dirname(filepath)
     
-    for line in lines:
-        if line.strip().startswith('#include "'):
-            include_path = line.split('"')[1]
-            full_include_path = os.path.normpath(os.path.join(shader_dir, include_path))
-            new_content.append(process_includes(full_include_path, processed_files))
-        else:
-            new_content.append(line)
-            
-    return "".join(new_content)
+    def expand(match):
+        full_include_path = os.path.normpath(os.path.join(shader_dir, match.group(1)))
+        return process_includes(full_include_path, processed_files)
+    
+    return INCLUDE_RE.sub(expand, read_source(filepath))
 
 def main(shader_dir, output_file):
     print(f"Embedding shaders from {shader_dir} into {output_file}")
@@ -69,7 +71,7 @@ def main(shader_dir, output_file):
                     content = process_includes(filepath)
                     
                     # Escape quotes and newlines for C++ string literal
-                    content_escaped = content.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n"\n"')
+                    content_escaped = content.translate(CPP_ESCAPE)
                     
                     f.write(f'        {{ "{rel_path}", "{content_escaped}" }},\n')
         
@@ -114,6 +114,40 @@ std::vector<Match> SIFTMatcher::MatchDescriptors(const std::vector<float>& descA
         queue_.writeBuffer(bufB, 0, descB.data(), sizeB);
     }
 
+    return runMatch(pipe, bufA, sizeA, countA, bufB, sizeB, countB, ratio_threshold);
+}
+
+void SIFTMatcher::SetQueryDescriptors(const std::vector<float>& descA) {
+    query_count_ = descA.size() / 128;
+    query_size_ = descA.size() * 4;
+    if (descA.empty()) {
+        query_buf_ = wgpu::Buffer();
+        return;
+    }
+    query_buf_ = createBuffer(query_size_, wgpu::BufferUsage::Storage | wgpu::BufferUsage::CopyDst);
+    queue_.writeBuffer(query_buf_, 0, descA.data(), query_size_);
+}
+
+std::vector<Match> SIFTMatcher::MatchPrebuilt(const std::vector<float>& descB, float ratio_threshold) {
+    if (!query_buf_ || descB.empty()) return {};
+    if (!pipeline_) {
+        std::cerr << "[SIFTMatcher] Pipeline not initialized" << std::endl;
+        return {};
+    }
+
+    uint32_t countB = descB.size() / 128;
+    size_t sizeB = descB.size() * 4;
+    wgpu::Buffer bufB = createBuffer(sizeB, wgpu::BufferUsage::Storage | wgpu::BufferUsage::CopyDst);
+    queue_.writeBuffer(bufB, 0, descB.data(), sizeB);
+
+    return runMatch(pipeline_, query_buf_, query_size_, query_count_, bufB, sizeB, countB, ratio_threshold);
+}
+
+std::vector<Match> SIFTMatcher::runMatch(wgpu::ComputePipeline pipe,
+                                         wgpu::Buffer bufA, size_t sizeA, uint32_t countA,
+                                         wgpu::Buffer bufB, size_t sizeB, uint32_t countB,
+                                         float ratio_threshold) {
+    std::vector<Match> matches;
     size_t resSize = countA * sizeof(GPUMatchResult);
     wgpu::Buffer bufRes = createBuffer(resSize, wgpu::BufferUsage::Storage | wgpu::BufferUsage::CopySrc);
     uint32_t params[] = {countA, countB, 0, 0};
@@ -23,6 +23,12 @@ class SIFTMatcher {
                                         const std::vector<float>& descB, 
                                         float ratio_threshold = 0.75f,
                                         bool quantize = false);
+
+    // Uploads descA once so it can be matched against many descB sets
+    // without re-uploading (exhaustive matching of image collections).
+    void SetQueryDescriptors(const std::vector<float>& descA);
+    std::vector<Match> MatchPrebuilt(const std::vector<float>& descB,
+                                     float ratio_threshold = 0.75f);
     
     // Guided matching with F-matrix
     // keypoints are flattened [x0, y0, x1, y1...]
@@ -42,9 +48,18 @@ class SIFTMatcher {
     wgpu::ComputePipeline pipeline_guided_; // New pipeline
     
     wgpu::Buffer params_buf_;
+
+    // Resident query descriptors (SetQueryDescriptors)
+    wgpu::Buffer query_buf_;
+    size_t query_size_ = 0;
+    uint32_t query_count_ = 0;
     
     // Helpers
     wgpu::Buffer createBuffer(size_t size, wgpu::BufferUsage usage);
+    std::vector<Match> runMatch(wgpu::ComputePipeline pipe,
+                                wgpu::Buffer bufA, size_t sizeA, uint32_t countA,
+                                wgpu::Buffer bufB, size_t sizeB, uint32_t countB,
+                                float ratio_threshold);
     std::string loadShader(const std::string& name); // Updated to take name
 };
 
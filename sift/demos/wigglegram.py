@@ -6,6 +6,7 @@ and generates an animated GIF alternating between the rectified views.
 """
 
 import base64
+import binascii
 import io
 import numpy as np
 
@@ -24,21 +25,74 @@ except ImportError:
     print("Warning: PIL not available")
 
 
-def decode_image(base64_str):
-    """Decode base64 image string to numpy array"""
-    img_data = base64.b64decode(base64_str)
+# Shared FLANN matcher (KD-tree index for float SIFT descriptors)
+FLANN_INDEX_KDTREE = 1
+_flann = cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_KDTREE, trees=4),
+                               dict(checks=32, eps=0.0)) if HAS_CV2 else None
+
+# Reduced-resolution decode flags keyed by downscale factor
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+} if HAS_CV2 else {}
+
+# Homography reprojection / inlier threshold, in original (full-resolution) pixels
+REPROJ_THRESHOLD = 5.0
+
+# USAC (MAGSAC++) needs OpenCV >= 4.5; fall back to classic RANSAC
+HOMOGRAPHY_METHOD = getattr(cv2, 'USAC_MAGSAC', cv2.RANSAC) if HAS_CV2 else None
+
+# Use OpenCV's CUDA module for per-pixel warps/resizes when a device is present
+try:
+    HAS_CUDA = HAS_CV2 and cv2.cuda.getCudaEnabledDeviceCount() > 0
+except (AttributeError, cv2.error):
+    HAS_CUDA = False
+
+
+def decode_image(base64_str, min_side=0):
+    """
+    Decode base64 image string to numpy array.
+    
+    If min_side > 0, the image is decoded at 1/2, 1/4 or 1/8 resolution (done in the
+    JPEG decoder itself) as long as its longer side stays >= min_side.
+    
+    Returns:
+        (img, scale) where scale maps original pixel coordinates to the decoded image
+    """
+    img_data = binascii.a2b_base64(base64_str)
     img_array = np.frombuffer(img_data, dtype=np.uint8)
-    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-    return img
+    
+    flags = cv2.IMREAD_COLOR
+    if min_side > 0 and HAS_PIL:
+        try:
+            # Header-only read for the original size
+            orig_side = max(Image.open(io.BytesIO(img_data)).size)
+        except Exception:
+            orig_side = 0
+        for factor in (8, 4, 2):
+            if orig_side // factor >= min_side:
+                flags = REDUCED_DECODE_FLAGS[factor]
+                break
+    
+    img = cv2.imdecode(img_array, flags)
+    if img is None:
+        return None, 1.0
+    if flags == cv2.IMREAD_COLOR:
+        return img, 1.0
+    # Longer sides are compared so EXIF rotation applied by imdecode doesn't matter
+    return img, max(img.shape[:2]) / orig_side
 
 
 def encode_gif(frames, duration_ms=200):
     """Encode list of numpy images to GIF base64 string"""
-    pil_frames = []
-    for frame in frames:
-        # Convert BGR to RGB for PIL
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_frames.append(Image.fromarray(rgb))
+    # Convert BGR to RGB for PIL (channel swap view + one contiguous copy)
+    rgb_frames = [Image.fromarray(np.ascontiguousarray(frame[..., ::-1])) for frame in frames]
+    
+    # GIF is palettized: build one palette from the first frame and reuse it for
+    # the others so the encoder doesn't quantize every frame independently
+    first = rgb_frames[0].quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+    pil_frames = [first] + [f.quantize(palette=first) for f in rgb_frames[1:]]
     
     # Save to bytes buffer
     buffer = io.BytesIO()
@@ -54,71 +108,113 @@ def encode_gif(frames, duration_ms=200):
     return base64.b64encode(buffer.getvalue()).decode('utf-8')
 
 
+def keypoints_to_soa(keypoints, with_descriptors=True):
+    """
+    Convert a list of keypoint dicts to contiguous arrays.
+    
+    Returns:
+        dict with 'xy' ((N, 2) float32) and, if with_descriptors, 'desc' ((N, 128) float32)
+    """
+    soa = {'xy': np.array([[kp['x'], kp['y']] for kp in keypoints], dtype=np.float32).reshape(-1, 2)}
+    if with_descriptors:
+        soa['desc'] = np.array([kp['descriptor'] for kp in keypoints], dtype=np.float32).reshape(-1, 128)
+    return soa
+
+
 def match_keypoints(keypoints_a, keypoints_b, ratio_threshold=0.75):
-    """Match keypoints between two images using FLANN"""
+    """Match keypoints between two images using FLANN.
+
+    Keypoints may be lists of keypoint dicts or arrays from keypoints_to_soa.
+    """
+    empty = np.empty((0, 2), np.float32)
     if not HAS_CV2:
-        return [], []
+        return empty, empty
     
-    # Extract descriptors
-    desc_a = np.array([kp['descriptor'] for kp in keypoints_a], dtype=np.float32)
-    desc_b = np.array([kp['descriptor'] for kp in keypoints_b], dtype=np.float32)
+    if not isinstance(keypoints_a, dict):
+        keypoints_a = keypoints_to_soa(keypoints_a)
+    if not isinstance(keypoints_b, dict):
+        keypoints_b = keypoints_to_soa(keypoints_b)
     
-    if len(desc_a) < 2 or len(desc_b) < 2:
-        return [], []
+    desc_a = keypoints_a['desc']
+    desc_b = keypoints_b['desc']
     
-    # FLANN matching
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50)
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
+    if len(desc_a) < 2 or len(desc_b) < 2:
+        return empty, empty
     
-    matches = flann.knnMatch(desc_a, desc_b, k=2)
+    matches = _flann.knnMatch(desc_a, desc_b, k=2)
+    matches = [pair for pair in matches if len(pair) == 2]
+    if not matches:
+        return empty, empty
     
-    # Apply ratio test
-    pts_a = []
-    pts_b = []
-    for match_pair in matches:
-        if len(match_pair) == 2:
-            m, n = match_pair
-            if m.distance < ratio_threshold * n.distance:
-                pts_a.append([keypoints_a[m.queryIdx]['x'], keypoints_a[m.queryIdx]['y']])
-                pts_b.append([keypoints_b[m.trainIdx]['x'], keypoints_b[m.trainIdx]['y']])
+    # Gather (N, 2) distance / index arrays and apply the ratio test as a mask
+    n = len(matches)
+    dist = np.fromiter((m.distance for pair in matches for m in pair), np.float32, 2 * n).reshape(n, 2)
+    query_idx = np.fromiter((pair[0].queryIdx for pair in matches), np.int64, n)
+    train_idx = np.fromiter((pair[0].trainIdx for pair in matches), np.int64, n)
+    mask = dist[:, 0] < ratio_threshold * dist[:, 1]
     
-    return np.array(pts_a, dtype=np.float32), np.array(pts_b, dtype=np.float32)
+    return keypoints_a['xy'][query_idx[mask]], keypoints_b['xy'][train_idx[mask]]
+
+
+def warp_perspective(img, H, size):
+    """Warp img with homography H to size (w, h), on the GPU if available"""
+    if HAS_CUDA:
+        gpu_img = cv2.cuda_GpuMat()
+        gpu_img.upload(img)
+        return cv2.cuda.warpPerspective(gpu_img, H, size).download()
+    return cv2.warpPerspective(img, H, size)
+
 
+def resize(img, size, interpolation=None):
+    """Resize img to size (w, h), on the GPU if available"""
+    if interpolation is None:
+        interpolation = cv2.INTER_LINEAR
+    if HAS_CUDA:
+        gpu_img = cv2.cuda_GpuMat()
+        gpu_img.upload(img)
+        return cv2.cuda.resize(gpu_img, size, interpolation=interpolation).download()
+    return cv2.resize(img, size, interpolation=interpolation)
 
-def compute_homography(pts_a, pts_b, min_matches=4):
-    """Compute homography from matched points using RANSAC"""
+
+def compute_homography(pts_a, pts_b, min_matches=4, threshold=REPROJ_THRESHOLD):
+    """Compute homography from matched points using MAGSAC++ (RANSAC on older OpenCV)"""
     if len(pts_a) < min_matches:
         return None
     
-    H, mask = cv2.findHomography(pts_b, pts_a, cv2.RANSAC, 5.0)
+    if HOMOGRAPHY_METHOD == cv2.RANSAC:
+        H, mask = cv2.findHomography(pts_b, pts_a, cv2.RANSAC, threshold)
+    else:
+        H, mask = cv2.findHomography(pts_b, pts_a, method=HOMOGRAPHY_METHOD, ransacReprojThreshold=threshold,
+                                     maxIters=2000, confidence=0.999)
     return H
 
 
-def rectify_images(img_a, img_b, pts_a, pts_b):
+def rectify_images(img_a, img_b, pts_a, pts_b, threshold=REPROJ_THRESHOLD):
     """
     Rectify stereo images for wigglegram viewing.
     Uses homography to align image B to image A's coordinate frame.
+    
+    threshold is the reprojection/inlier distance in img_a's pixels.
     """
     h, w = img_a.shape[:2]
     
     # Compute homography (B -> A)
-    H = compute_homography(pts_a, pts_b)
+    H = compute_homography(pts_a, pts_b, threshold=threshold)
     
     if H is None:
         # Fallback: just resize to same dimensions
         print("Warning: Not enough matches for homography, using identity")
-        img_b_rectified = cv2.resize(img_b, (w, h))
+        img_b_rectified = resize(img_b, (w, h))
         return img_a, img_b_rectified, 0
     
     # Warp image B to align with image A
-    img_b_rectified = cv2.warpPerspective(img_b, H, (w, h))
+    img_b_rectified = warp_perspective(img_b, H, (w, h))
     
-    # Count inliers
-    pts_b_warped = cv2.perspectiveTransform(pts_b.reshape(-1, 1, 2), H).reshape(-1, 2)
-    distances = np.sqrt(np.sum((pts_a - pts_b_warped) ** 2, axis=1))
-    inliers = np.sum(distances < 5.0)
+    # Count inliers (projective transform of B points in homogeneous coordinates)
+    q = pts_b @ H[:, :2].T + H[:, 2]
+    pts_b_warped = q[:, :2] / q[:, 2:3]
+    distances = np.linalg.norm(pts_a - pts_b_warped, axis=1)
+    inliers = np.count_nonzero(distances < threshold)
     
     return img_a, img_b_rectified, int(inliers)
 
@@ -145,30 +241,42 @@ def create_wigglegram(img_a_base64, img_b_base64, keypoints_a, keypoints_b,
     
     try:
         # Decode images
-        img_a = decode_image(img_a_base64)
-        img_b = decode_image(img_b_base64)
+        # Output is capped at max_size, so large inputs can be decoded at reduced resolution
+        img_a, scale_a = decode_image(img_a_base64, min_side=max_size)
+        img_b, scale_b = decode_image(img_b_base64, min_side=max_size)
         
         if img_a is None or img_b is None:
             return {"error": "Failed to decode images"}
         
+        # Convert keypoints to arrays once; every step below works on views of these
+        try:
+            soa_a = keypoints_to_soa(keypoints_a, with_descriptors=not matches)
+            soa_b = keypoints_to_soa(keypoints_b, with_descriptors=not matches)
+        except (TypeError, KeyError, ValueError) as e:
+            return {"error": f"Invalid keypoints: {e}"}
+        
         # Match keypoints
         if matches:
-            # Reconstruct points from indices
-            pts_a = []
-            pts_b = []
+            # Reconstruct points from indices with a single gather per image
             try:
-                for idx_a, idx_b in matches:
-                    pts_a.append([keypoints_a[idx_a]['x'], keypoints_a[idx_a]['y']])
-                    pts_b.append([keypoints_b[idx_b]['x'], keypoints_b[idx_b]['y']])
+                m = np.asarray(matches, dtype=np.int64)
+                if m.ndim != 2 or m.shape[1] != 2:
+                    raise ValueError(f"expected [idx_a, idx_b] pairs, got shape {m.shape}")
                 
-                pts_a = np.array(pts_a, dtype=np.float32)
-                pts_b = np.array(pts_b, dtype=np.float32)
-            except (IndexError, TypeError, KeyError) as e:
+                pts_a = soa_a['xy'][m[:, 0]]
+                pts_b = soa_b['xy'][m[:, 1]]
+            except (IndexError, TypeError, ValueError) as e:
                  return {"error": f"Invalid match indices: {e}"}
         else:
             # Use FLANN
-            pts_a, pts_b = match_keypoints(keypoints_a, keypoints_b)
+            pts_a, pts_b = match_keypoints(soa_a, soa_b)
             
+        # Bring keypoint coordinates into the decoded images' pixel space
+        if scale_a != 1.0:
+            pts_a = pts_a * np.float32(scale_a)
+        if scale_b != 1.0:
+            pts_b = pts_b * np.float32(scale_b)
+        
         match_count = len(pts_a)
         
         print(f"[Wigglegram] Matched {match_count} keypoints")
@@ -176,8 +284,10 @@ def create_wigglegram(img_a_base64, img_b_base64, keypoints_a, keypoints_b,
         if match_count < 4:
             return {"error": f"Only {match_count} matches found, need at least 4"}
         
-        # Rectify
-        rect_a, rect_b, inliers = rectify_images(img_a, img_b, pts_a, pts_b)
+        # Rectify; residuals are measured in image A's decoded pixels, so the threshold
+        # is scaled to keep it REPROJ_THRESHOLD original pixels
+        rect_a, rect_b, inliers = rectify_images(img_a, img_b, pts_a, pts_b,
+                                                 threshold=REPROJ_THRESHOLD * scale_a)
         
         print(f"[Wigglegram] Rectification complete, {inliers} inliers")
         
@@ -187,8 +297,8 @@ def create_wigglegram(img_a_base64, img_b_base64, keypoints_a, keypoints_b,
             scale = max_size / max(h, w)
             new_w = int(w * scale)
             new_h = int(h * scale)
-            rect_a = cv2.resize(rect_a, (new_w, new_h), interpolation=cv2.INTER_AREA)
-            rect_b = cv2.resize(rect_b, (new_w, new_h), interpolation=cv2.INTER_AREA)
+            rect_a = resize(rect_a, (new_w, new_h), interpolation=cv2.INTER_AREA)
+            rect_b = resize(rect_b, (new_w, new_h), interpolation=cv2.INTER_AREA)
         
         # Create GIF with both frames
         gif_base64 = encode_gif([rect_a, rect_b], duration_ms=frame_duration_ms)
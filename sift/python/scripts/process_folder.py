@@ -1,4 +1,5 @@
 
+import io
 import os
 import sys
 import argparse
@@ -29,6 +30,9 @@ except ImportError:
     # Actually we will try to use PIL if cv2 missing, or vice versa.
     pass
 
+# Byte scaling of the L2-clip-L2 normalized descriptors written to .sift files
+DESC_SCALE = 512
+
 def load_image(path, max_dim=0):
     """Load image as RGBA uint8 numpy array. Returns (img, restore_factor)."""
     restore_factor = 1.0
@@ -82,41 +86,35 @@ def load_image(path, max_dim=0):
             return None, 1.0
 
 def save_sift_format(filepath, keypoints):
-    """Save keypoints in VisualSFM/Lowe ASCII format"""
+    """Save keypoints in VisualSFM/Lowe ASCII format. Returns the quantized (N, 128) descriptors written."""
     # Format: 
     # <count> 128
     # y x scale ori d0 ... d127 (Lowe's format matches x/y order of COLMAP/VisualSFM in practice)
     
-    with open(filepath, 'w') as f:
-        f.write(f"{len(keypoints)} 128\n")
+    n = len(keypoints)
+    descs_u8 = np.zeros((0, 128), dtype=np.uint16)
+    
+    # Format the whole file in memory and write it with a single call
+    buf = io.BytesIO()
+    buf.write(f"{n} 128\n".encode())
+    
+    if n > 0:
+        # Gather keypoint metadata and descriptors into (N, 4) / (N, 128) arrays
+        meta = np.array([(kp['x'], kp['y'], kp['scale'], kp['orientation']) for kp in keypoints], dtype=np.float64)
+        descs = np.stack([np.asarray(kp.get('descriptor', np.zeros(128)), dtype=np.float32) for kp in keypoints])
         
-        for kp in keypoints:
-            x = kp['x']
-            y = kp['y']
-            scale = kp['scale']
-            ori = kp['orientation']
-            desc = kp.get('descriptor', np.zeros(128))
-            
-            # Normalize and clamp descriptor to [0, 255] integer range
-            desc = np.array(desc, dtype=np.float32)
-            norm = np.linalg.norm(desc)
-            if norm > 1e-6:
-                desc /= norm
-            
-            # Clip high peaks to reduce influence of large gradients
-            np.clip(desc, 0, 0.2, out=desc)
-            
-            # Re-normalize
-            norm = np.linalg.norm(desc)
-            if norm > 1e-6:
-                desc /= norm
-            
-            # Scale to byte [0, 255]
-            desc = (desc * 512).clip(0, 255).astype(int)
-            
-            # Write keypoint line
-            desc_str = " ".join(map(str, desc))
-            f.write(f"{x:.4f} {y:.4f} {scale:.4f} {ori:.4f} {desc_str}\n")
+        # Normalize, clip high peaks and re-normalize (SIFT L2-clip-L2)
+        normalize_descriptors(descs)
+        
+        # Scale to byte [0, 255]
+        descs_u8 = (descs * DESC_SCALE).clip(0, 255).astype(np.uint16)
+        
+        np.savetxt(buf, np.hstack([meta, descs_u8]), fmt=['%.4f'] * 4 + ['%d'] * 128)
+    
+    with open(filepath, 'wb') as f:
+        f.write(buf.getbuffer())
+    
+    return descs_u8
 
 def normalize_descriptors(descs_np):
     """Normalize descriptors using SIFT L2-clip-L2 logic."""
@@ -134,14 +132,21 @@ def normalize_descriptors(descs_np):
     return descs_np
 
 import concurrent.futures
+import queue
 
 def load_image_task(args):
     """Worker function for loading images in parallel."""
     path, max_dim = args
     return load_image(path, max_dim)
 
-def load_sift_descriptors(filepath):
-    """Load descriptors from a .sift file."""
+def load_sift_descriptors(filepath, normalized=True):
+    """
+    Load descriptors from a .sift file.
+    
+    normalized: the file was written by save_sift_format, whose descriptors are already
+    L2-clip-L2 normalized, so only the byte scaling is undone. Pass False for .sift
+    files from other tools to normalize them here.
+    """
     try:
         with open(filepath, 'r') as f:
             line = f.readline()
@@ -154,24 +159,28 @@ def load_sift_descriptors(filepath):
             if count == 0:
                 return np.zeros((0, 128), dtype=np.float32)
             
-            descriptors = []
-            for _ in range(count):
-                line = f.readline()
-                if not line: break
-                vals = list(map(float, line.strip().split()))
-                # Format: y x scale ori d0..d127
-                # Descriptor starts at index 4
-                desc = vals[4:]
-                descriptors.append(desc)
-                
-            descs_np = np.array(descriptors, dtype=np.float32)
+            # Parse the whole body in C rather than float() per token
+            # Format: y x scale ori d0..d127
+            vals = np.fromstring(f.read(), dtype=np.float32, sep=' ')
+            rows = min(count, vals.size // (4 + dim))
+            vals = vals[:rows * (4 + dim)].reshape(rows, 4 + dim)
+            
+            # Descriptor starts at index 4
+            if normalized:
+                # Written by save_sift_format: undo the byte scaling only
+                return vals[:, 4:] * np.float32(1.0 / DESC_SCALE)
+            descs_np = np.ascontiguousarray(vals[:, 4:])
             return normalize_descriptors(descs_np)
     except Exception as e:
         print(f"Error loading descriptors from {filepath}: {e}")
         return None
 
-def process_images(sift, files, input_dir, output_dir, max_dim=0, num_threads=4):
-    """Detect features in images using parallel loading and sequential GPU processing."""
+def process_images(sift, files, input_dir, output_dir, max_dim=0, num_threads=4, desc_cache=None):
+    """Detect features in images using parallel loading and sequential GPU processing.
+
+    If desc_cache is a dict, it is filled with {sift_path: descriptors} exactly as
+    load_sift_descriptors would return them, so matching can skip re-reading the files.
+    """
     total_time = 0
     start_total_time = time.time()
     count = 0
@@ -184,11 +193,26 @@ def process_images(sift, files, input_dir, output_dir, max_dim=0, num_threads=4)
     # Use ProcessPoolExecutor for true CPU parallelism (bypassing GIL)
     # This is crucial for operations like image resizing which might not fully release GIL or contend.
     with concurrent.futures.ProcessPoolExecutor(max_workers=num_threads) as executor:
-        # Submit all tasks. 
-        future_to_file = {executor.submit(load_image_task, arg): f for arg, f in zip(load_args, files)}
+        # Producer/consumer pipeline: loaders push finished images onto a queue while the
+        # main thread runs GPU detection. In-flight loads are bounded so decoded images
+        # don't pile up in memory when the GPU is the slower stage.
+        ready = queue.Queue()
+        pending = iter(zip(load_args, files))
+        
+        def submit_next():
+            task = next(pending, None)
+            if task is None:
+                return
+            arg, fname = task
+            future = executor.submit(load_image_task, arg)
+            future.add_done_callback(lambda fut, fname=fname: ready.put((fname, fut)))
         
-        for future in concurrent.futures.as_completed(future_to_file):
-            fname = future_to_file[future]
+        for _ in range(2 * num_threads):
+            submit_next()
+        
+        for _ in range(len(files)):
+            fname, future = ready.get()
+            submit_next()
             try:
                 img, restore_factor = future.result()
             except Exception as e:
@@ -220,7 +244,9 @@ def process_images(sift, files, input_dir, output_dir, max_dim=0, num_threads=4)
             # Save
             base_name = os.path.splitext(fname)[0]
             sift_path = os.path.join(output_dir, base_name + ".sift")
-            save_sift_format(sift_path, kps)
+            descs_u8 = save_sift_format(sift_path, kps)
+            if desc_cache is not None:
+                desc_cache[sift_path] = descs_u8 * np.float32(1.0 / DESC_SCALE)
             valid_files.append(fname)
 
     if count > 0:
@@ -229,87 +255,96 @@ def process_images(sift, files, input_dir, output_dir, max_dim=0, num_threads=4)
         
     return valid_files
 
-def perform_matching(files, output_dir, match_ratio=0.75, num_threads=4):
-    """Perform exhaustive matching using GPU Matcher with parallel descriptor loading."""
+def init_matcher():
+    """Create a GPU matcher with its own WebGPU device."""
+    matcher = websiftgpu_py.SIFTMatcher()
+    matcher.init()
+    return matcher
+
+def perform_matching(files, output_dir, match_ratio=0.75, num_threads=4, desc_cache=None, num_matchers=2):
+    """Perform exhaustive matching using GPU Matcher with parallel descriptor loading.
+
+    desc_cache maps .sift paths to already decoded descriptors; only missing files are read from disk.
+    Rows of the pair matrix are spread over num_matchers matcher instances running concurrently.
+    """
     if len(files) < 2:
         return
 
     print(f"Performing exhaustive matching (Ratio: {match_ratio}) with {num_threads} threads for loading...")
     matches_path = os.path.join(output_dir, "matches.txt")
     
-    # Init matcher
+    # Init matchers (one device each so GPU work can overlap)
     try:
-        matcher = websiftgpu_py.SIFTMatcher()
-        matcher.init()
-        print("Initialized GPU Matcher.")
+        matchers = [init_matcher() for _ in range(max(1, num_matchers))]
+        print(f"Initialized {len(matchers)} GPU Matcher(s).")
     except Exception as e:
         print(f"Failed to init GPU Matcher: {e}")
         print("Falling back to CPU matching not implemented fully in this branch.")
         sys.exit(1)
     
-    with open(matches_path, 'w') as f_out:
-        # We need a persistent executor for the inner loop tasks
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    # Decode every descriptor file at most once (parallel parsing for cache misses)
+    if desc_cache is None:
+        desc_cache = {}
+    paths = [os.path.join(output_dir, os.path.splitext(name)[0] + ".sift") for name in files]
+    missing = [p for p in paths if p not in desc_cache]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        desc_cache.update(zip(missing, executor.map(load_sift_descriptors, missing)))
+    descs = [desc_cache[p] for p in paths]
+    
+    # Prefer uploading each query set to the GPU once and reusing it for all j > i
+    has_prebuilt = hasattr(matchers[0], 'set_query') and hasattr(matchers[0], 'match_prebuilt')
+    
+    # Each worker borrows a matcher for a whole row i (its query set stays resident)
+    idle_matchers = queue.Queue()
+    for matcher in matchers:
+        idle_matchers.put(matcher)
+    
+    def match_row(i):
+        desc1 = descs[i]
+        matcher = idle_matchers.get()
+        try:
+            if has_prebuilt:
+                matcher.set_query(desc1)
             
-            for i in range(len(files)):
-                name1 = files[i]
-                base1 = os.path.splitext(name1)[0]
-                path1 = os.path.join(output_dir, base1 + ".sift")
-                
-                # Load query descriptor (can be done on main or thread, main is fine for outer loop)
-                desc1 = load_sift_descriptors(path1)
-                
-                if desc1 is None or len(desc1) == 0:
+            row = []
+            for j in range(i + 1, len(files)):
+                desc2 = descs[j]
+                if desc2 is None or len(desc2) == 0:
                     continue
                 
-                # Prepare tasks for all j > i
-                future_to_index = {}
-                for j in range(i + 1, len(files)):
-                    name2 = files[j]
-                    base2 = os.path.splitext(name2)[0]
-                    path2 = os.path.join(output_dir, base2 + ".sift")
-                    future = executor.submit(load_sift_descriptors, path2)
-                    future_to_index[future] = j
-
-                # Process results as they come in (Order doesn't strictly match j order, but pairs are unique)
-                # If strict order in file is needed, we would wait differently, but for matches.txt usually any order is fine
-                # as long as pairs are unique. However, standard convention usually follows loop order.
-                # Let's enforce order to be deterministic.
-                
-                # To force order:
-                # We can just iterate the list of futures we just created
-                sorted_futures = list(future_to_index.keys()) 
-                # Note: This means we wait for j=i+1, then j=i+2. Parallelism helps if loading is slow.
+                if has_prebuilt:
+                    matches = matcher.match_prebuilt(desc2, match_ratio)
+                else:
+                    matches = matcher.match(desc1, desc2, match_ratio)
                 
-                for future in sorted_futures:
-                    j = future_to_index[future]
+                if len(matches) > 0:
+                    row.append((j, matches))
+            return row
+        finally:
+            idle_matchers.put(matcher)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(matchers)) as executor:
+        rows = [(i, executor.submit(match_row, i)) for i in range(len(files))
+                if descs[i] is not None and len(descs[i]) > 0]
+        
+        # Results are written from the main thread in (i, j) order to keep matches.txt deterministic
+        with open(matches_path, 'w') as f_out:
+            for i, future in rows:
+                name1 = files[i]
+                for j, matches in future.result():
                     name2 = files[j]
+                    valid_indices = matches[:, 0]
+                    matched_targets = matches[:, 1]
                     
-                    try:
-                        desc2 = future.result()
-                    except Exception as e:
-                        print(f"Error loading {name2}: {e}")
-                        continue
-                        
-                    if desc2 is None or len(desc2) == 0:
-                        continue
-
-                    # GPU Match (Sequential)
-                    matches = matcher.match(desc1, desc2, match_ratio)
+                    f_out.write(f"{name1}\n")
+                    f_out.write(f"{name2}\n")
+                    f_out.write(f"{len(matches)}\n")
                     
-                    if len(matches) > 0:
-                        valid_indices = matches[:, 0]
-                        matched_targets = matches[:, 1]
-                        
-                        f_out.write(f"{name1}\n")
-                        f_out.write(f"{name2}\n")
-                        f_out.write(f"{len(matches)}\n")
-                        
-                        for k in range(len(matches)):
-                            f_out.write(f"{valid_indices[k]} {matched_targets[k]}\n")
-                        
-                        f_out.write("\n") 
-                        print(f"  Matches {name1} vs {name2}: {len(matches)}")
+                    for k in range(len(matches)):
+                        f_out.write(f"{valid_indices[k]} {matched_targets[k]}\n")
+                    
+                    f_out.write("\n") 
+                    print(f"  Matches {name1} vs {name2}: {len(matches)}")
 
 
 def main():
@@ -325,6 +360,7 @@ def main():
     
     parser.add_argument("--max_dimension", type=int, default=0, help="Max image dimension for processing (0 = ignore). Resizes on CPU, scales Keypoints back.")
     parser.add_argument("--num_threads", type=int, default=4, help="Number of threads for image loading and descriptor fetching (default: 4)")
+    parser.add_argument("--num_matchers", type=int, default=2, help="Number of GPU matcher instances running concurrently (default: 2)")
 
     args = parser.parse_args()
     
@@ -347,12 +383,15 @@ def main():
         
     files = [f for f in os.listdir(input_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
     
+    # Keep decoded descriptors in memory between detection and matching
+    desc_cache = {} if args.match_images else None
+    
     # Process
-    valid_files = process_images(sift, files, input_dir, output_dir, args.max_dimension, args.num_threads)
+    valid_files = process_images(sift, files, input_dir, output_dir, args.max_dimension, args.num_threads, desc_cache)
     
     # Match
     if args.match_images:
-        perform_matching(valid_files, output_dir, args.match_ratio, args.num_threads)
+        perform_matching(valid_files, output_dir, args.match_ratio, args.num_threads, desc_cache, args.num_matchers)
 
 if __name__ == "__main__":
     main()
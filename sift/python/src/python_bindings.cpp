@@ -189,7 +189,12 @@ PYBIND11_MODULE(websiftgpu_py, m) {
             std::vector<float> vecA((float*)bufA.ptr, (float*)bufA.ptr + bufA.size);
             std::vector<float> vecB((float*)bufB.ptr, (float*)bufB.ptr + bufB.size);
 
-            auto matches = self.MatchDescriptors(vecA, vecB, ratio);
+            std::vector<Match> matches;
+            {
+                // Release the GIL while the GPU works so several matchers can run from Python threads
+                py::gil_scoped_release release;
+                matches = self.MatchDescriptors(vecA, vecB, ratio);
+            }
             
             // Return N x 2 numpy array (queryIdx, trainIdx)
             // SIFTMatcher::Match returns struct { trainIdx, queryIdx, distance }
@@ -208,5 +213,35 @@ PYBIND11_MODULE(websiftgpu_py, m) {
             
             return result;
         }, "Match descriptors. Returns Nx2 array of [queryIdx, trainIdx]", 
-           py::arg("desc1"), py::arg("desc2"), py::arg("ratio") = 0.75f);
+           py::arg("desc1"), py::arg("desc2"), py::arg("ratio") = 0.75f)
+
+        .def("set_query", [](SIFTMatcher& self, py::array_t<float> descA) {
+            py::buffer_info bufA = descA.request();
+            if (bufA.ndim != 2 || bufA.shape[1] != 128) throw std::runtime_error("desc1 must be N x 128");
+
+            std::vector<float> vecA((float*)bufA.ptr, (float*)bufA.ptr + bufA.size);
+            self.SetQueryDescriptors(vecA);
+        }, "Upload query descriptors once for repeated match_prebuilt calls", py::arg("desc1"))
+
+        .def("match_prebuilt", [](SIFTMatcher& self, py::array_t<float> descB, float ratio) {
+            py::buffer_info bufB = descB.request();
+            if (bufB.ndim != 2 || bufB.shape[1] != 128) throw std::runtime_error("desc2 must be M x 128");
+
+            std::vector<float> vecB((float*)bufB.ptr, (float*)bufB.ptr + bufB.size);
+            std::vector<Match> matches;
+            {
+                // Release the GIL during GPU work (see match)
+                py::gil_scoped_release release;
+                matches = self.MatchPrebuilt(vecB, ratio);
+            }
+
+            py::array_t<int> result({ (int)matches.size(), 2 });
+            auto r = result.mutable_unchecked<2>();
+            for (int i = 0; i < matches.size(); i++) {
+                r(i, 0) = matches[i].queryIdx;
+                r(i, 1) = matches[i].trainIdx;
+            }
+            return result;
+        }, "Match descriptors against the query set from set_query. Returns Nx2 array of [queryIdx, trainIdx]",
+           py::arg("desc2"), py::arg("ratio") = 0.75f);
 }
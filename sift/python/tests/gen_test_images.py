@@ -16,10 +16,11 @@ w, h = 512, 512
 img = np.zeros((h, w, 3), dtype=np.uint8)
 img[:, :] = [50, 50, 50]
 # Draw some squares
-for i in range(10):
-    x = np.random.randint(0, w-50)
-    y = np.random.randint(0, h-50)
-    color = np.random.randint(0, 255, 3)
+n = 10
+xs = np.random.randint(0, w-50, n)
+ys = np.random.randint(0, h-50, n)
+colors = np.random.randint(0, 255, (n, 3), dtype=np.uint8)
+for x, y, color in zip(xs, ys, colors):
     img[y:y+50, x:x+50] = color
 
 img_pil = Image.fromarray(img)
@@ -1,14 +1,83 @@
 import json
-import math
 import sys
 import os
 
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 def load_json(path):
     with open(path, 'r') as f:
         return json.load(f)
 
-def dist(k1, k2):
-    return math.sqrt((k1['x'] - k2['x'])**2 + (k1['y'] - k2['y'])**2)
+def match_by_location(cpp_xy, web_xy, tol=1.0):
+    """Match each C++ keypoint to the nearest unused Web keypoint within tol pixels.
+
+    Returns an int array of Web indices per C++ keypoint (-1 if unmatched).
+    Candidates come from a grid of tol-sized cells: any neighbour within tol lies in
+    the 3x3 block of cells around the query, so each lookup touches a handful of points.
+    """
+    n = len(cpp_xy)
+    if n == 0 or len(web_xy) == 0:
+        return np.full(n, -1, dtype=np.int64)
+
+    # Cell coordinates, offset so that the -1 neighbour of every cell is still >= 0
+    origin = np.minimum(cpp_xy.min(axis=0), web_xy.min(axis=0)) - tol
+    cpp_cells = np.floor((cpp_xy - origin) / tol).astype(np.int64)
+    web_cells = np.floor((web_xy - origin) / tol).astype(np.int64)
+    rows = max(cpp_cells[:, 1].max(), web_cells[:, 1].max()) + 2
+
+    # Web keypoints sorted by cell key; each cell is a contiguous run
+    web_keys = web_cells[:, 0] * rows + web_cells[:, 1]
+    order = np.argsort(web_keys, kind='stable')
+    sorted_keys = web_keys[order]
+
+    cand_i = []
+    cand_j = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = (cpp_cells[:, 0] + dx) * rows + (cpp_cells[:, 1] + dy)
+            lo = np.searchsorted(sorted_keys, keys, side='left')
+            counts = np.searchsorted(sorted_keys, keys, side='right') - lo
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Expand each [lo, lo + count) run into (i, j) candidate pairs
+            run_start = np.repeat(np.cumsum(counts) - counts, counts)
+            cand_i.append(np.repeat(np.arange(n), counts))
+            cand_j.append(order[np.repeat(lo, counts) + np.arange(total) - run_start])
+
+    if not cand_i:
+        return np.full(n, -1, dtype=np.int64)
+
+    i = np.concatenate(cand_i)
+    j = np.concatenate(cand_j)
+    d2 = ((cpp_xy[i] - web_xy[j]) ** 2).sum(axis=1)
+    keep = d2 < tol * tol
+    i, j, d2 = i[keep], j[keep], d2[keep]
+
+    # Per C++ keypoint (in order), nearest first, ties broken by Web index
+    sort = np.lexsort((j, d2, i))
+    return _assign_greedy(n, len(web_xy), i[sort], j[sort])
+
+def _assign_greedy(n_cpp, n_web, cand_i, cand_j):
+    out = np.full(n_cpp, -1, dtype=np.int64)
+    used = np.zeros(n_web, dtype=np.bool_)
+    for k in range(len(cand_i)):
+        i = cand_i[k]
+        j = cand_j[k]
+        if out[i] >= 0 or used[j]:
+            continue
+        used[j] = True
+        out[i] = j
+    return out
+
+if HAS_NUMBA:
+    _assign_greedy = njit(cache=True)(_assign_greedy)
 
 def compare(cpp_path, web_path):
     if not os.path.exists(cpp_path):
@@ -31,43 +100,20 @@ def compare(cpp_path, web_path):
     print(f"C++ Keypoints: {len(kp_cpp)}")
     print(f"Web Keypoints: {len(kp_web)}")
     
-    matches = 0
-    total_desc_diff = 0.0
-    matched_indices = set()
+    cpp_xy = np.array([[k['x'], k['y']] for k in kp_cpp], dtype=np.float64).reshape(-1, 2)
+    web_xy = np.array([[k['x'], k['y']] for k in kp_web], dtype=np.float64).reshape(-1, 2)
     
-    for i, kc in enumerate(kp_cpp):
-        best_dist = 1e9
-        best_idx = -1
-        
-        for j, kw in enumerate(kp_web):
-            if j in matched_indices: continue
-            
-            # Simple spatial check first
-            if abs(kc['x'] - kw['x']) > 2.0 or abs(kc['y'] - kw['y']) > 2.0:
-                continue
-            
-            # Compare Scale/Octave?
-            # Keypoint matching should account for scale, but let's stick to location first
-            
-            d = dist(kc, kw)
-            if d < best_dist:
-                best_dist = d
-                best_idx = j
-                
-        if best_dist < 1.0: # 1 pixel tolerance
-            matches += 1
-            matched_indices.add(best_idx)
-            
-            # Compare descriptors
-            dc = desc_cpp[i]
-            dw = desc_web[best_idx]
-            
-            # L2 distance
-            dd = 0
-            for v1, v2 in zip(dc, dw):
-                dd += (v1 - v2)**2
-            l2 = math.sqrt(dd)
-            total_desc_diff += l2
+    # Keypoint matching should account for scale, but let's stick to location first
+    match_idx = match_by_location(cpp_xy, web_xy, tol=1.0) # 1 pixel tolerance
+    valid = match_idx >= 0
+    matches = int(valid.sum())
+    
+    # Compare descriptors (L2 distance)
+    total_desc_diff = 0.0
+    if matches > 0:
+        dc = np.asarray(desc_cpp, dtype=np.float32)[valid]
+        dw = np.asarray(desc_web, dtype=np.float32)[match_idx[valid]]
+        total_desc_diff = float(np.linalg.norm(dc - dw, axis=1).sum())
             
     print("-" * 30)
     print(f"Matches found: {matches}")
@@ -5,14 +5,16 @@ import os
 os.makedirs('tests/temp_test', exist_ok=True)
 
 # Create 800x600 image with strong features
-img = np.zeros((600, 800, 3), dtype=np.uint8)
-# Add random noise for texture
-img[:] = np.random.randint(0, 255, (600, 800, 3), dtype=np.uint8) 
+# Random noise for texture, generated directly as the image buffer
+img = np.random.default_rng().integers(0, 255, (600, 800, 3), dtype=np.uint8)
 # Add patterns
-for i in range(0, 800, 50):
-    cv2.line(img, (i, 0), (i, 600), (255, 255, 255), 2)
-for i in range(0, 600, 50):
-    cv2.line(img, (0, i), (800, i), (255, 255, 255), 2)
+# Grid lines as strided writes; a thickness-2 cv2.line covers x-1..x+1
+img[:, ::50] = 255
+img[:, 1::50] = 255
+img[:, 49:-1:50] = 255
+img[::50, :] = 255
+img[1::50, :] = 255
+img[49:-1:50, :] = 255
     
 cv2.circle(img, (400, 300), 100, (255, 0, 0), -1)
 
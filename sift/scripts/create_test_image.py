@@ -6,10 +6,13 @@ os.makedirs('tests/temp_test', exist_ok=True)
 # Create 2000x1500 image
 img = np.zeros((1500, 2000, 3), dtype=np.uint8)
 # Add some patterns to detect features
-for i in range(0, 2000, 100):
-    cv2.line(img, (i, 0), (i, 1500), (255, 255, 255), 2)
-for i in range(0, 1500, 100):
-    cv2.line(img, (0, i), (2000, i), (255, 255, 255), 2)
+# Grid lines as strided writes; a thickness-2 cv2.line covers x-1..x+1
+img[:, ::100] = 255
+img[:, 1::100] = 255
+img[:, 99:-1:100] = 255
+img[::100, :] = 255
+img[1::100, :] = 255
+img[99:-1:100, :] = 255
     
 cv2.circle(img, (1000, 750), 100, (255, 0, 0), -1)
 
@@ -5,6 +5,10 @@ Accepts keypoints and descriptors from the web client
 and performs matching using OpenCV's FLANN-based matcher.
 """
 
+import base64
+import math
+import threading
+
 import numpy as np
 
 try:
@@ -14,133 +18,385 @@ except ImportError:
     HAS_OPENCV = False
     print("Warning: OpenCV not available. Matching will return empty results.")
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+DESC_DIM = 128
+
+# Per-image keypoint cap for pair matching; the strongest responses are kept
+MAX_KEYPOINTS = 2048
+
+# Below this many descriptor pairs, an exact matmul-based search beats a 128-D KD-tree.
+# Capped inputs (MAX_KEYPOINTS) always take this path; FLANN only serves uncapped huge sets
+BRUTE_FORCE_MAX_PAIRS = 25_000_000
+# Rows of the distance matrix computed at once (bounds the temporary to ~16 MB)
+BRUTE_FORCE_BLOCK_ELEMS = 4_000_000
+
+FLANN_INDEX_KDTREE = 1
+FLANN_MAX_CHECKS = 200
+
+
+# Structured keypoint records the matcher works on (see pack_keypoints); coordinates stay
+# float64 so returned points round-trip exactly
+KEYPOINT_FIELDS = [('x', '<f8'), ('y', '<f8'), ('response', '<f4'), ('scale', '<f4')]
+KEYPOINT_DTYPE = np.dtype(KEYPOINT_FIELDS + [('desc', '<f4', (DESC_DIM,))])
+KEYPOINT_DTYPE_NO_DESC = np.dtype(KEYPOINT_FIELDS)
+
+
+def pack_keypoints(keypoints, with_descriptors=True):
+    """
+    Convert a list of keypoint dicts to a KEYPOINT_DTYPE structured array.
+    
+    Done once per request so matching never indexes the dicts again. Pass
+    with_descriptors=False when descriptors arrive separately as a blob.
+    """
+    n = len(keypoints)
+    packed = np.empty(n, dtype=KEYPOINT_DTYPE if with_descriptors else KEYPOINT_DTYPE_NO_DESC)
+    packed['x'] = np.fromiter((kp['x'] for kp in keypoints), np.float64, n)
+    packed['y'] = np.fromiter((kp['y'] for kp in keypoints), np.float64, n)
+    packed['response'] = np.fromiter((kp.get('response', 0.0) for kp in keypoints), np.float32, n)
+    packed['scale'] = np.fromiter((kp.get('scale', 0.0) for kp in keypoints), np.float32, n)
+    if with_descriptors:
+        packed['desc'] = np.array([kp['descriptor'] for kp in keypoints], dtype=np.float32).reshape(n, DESC_DIM)
+    return packed
+
+
+def decode_descriptors(blob, count):
+    """
+    Decode a base64 descriptor blob into an (N, 128) float32 array.
+    
+    The blob holds either float32 or uint8 (quantized, e.g. from /detect) values; the
+    element type is inferred from its length. uint8 values are widened to float32 so
+    both go through the same SGEMM/FLANN paths (exact for 8-bit inputs).
+    
+    Raises ValueError if the blob does not hold exactly count descriptors.
+    """
+    raw = base64.b64decode(blob)
+    if len(raw) == count * DESC_DIM:
+        return np.frombuffer(raw, dtype=np.uint8).reshape(count, DESC_DIM).astype(np.float32)
+    if len(raw) != count * DESC_DIM * 4:
+        raise ValueError(f"expected {count} x {DESC_DIM} float32 or uint8 descriptors, got {len(raw)} bytes")
+    return np.frombuffer(raw, dtype=np.float32).reshape(count, DESC_DIM)
+
+
+def extract_descriptors(keypoints, blob=None):
+    """Descriptors as an (N, 128) float32 array, from a base64 blob if given, else from packed keypoints"""
+    if blob is not None:
+        return decode_descriptors(blob, len(keypoints))
+    return np.ascontiguousarray(keypoints['desc'])
+
+
+def strongest_keypoints(keypoints, k):
+    """
+    Sorted indices of the k strongest packed keypoints, or None if there are at most k.
+    
+    Ranks by response, or by scale (larger first, as COLMAP's max_num_features does)
+    when the client sent no responses, e.g. the WebGPU detector. If neither varies
+    there is no meaningful ranking, but the cap is still enforced: an evenly strided
+    subset of k keypoints is kept instead.
+    """
+    n = len(keypoints)
+    if n <= k:
+        return None
+    for field in ('response', 'scale'):
+        rank = keypoints[field]
+        if rank.min() < rank.max():
+            return np.sort(np.argpartition(-rank, k)[:k])
+    print(f"[Matcher] Warning: {n} keypoints have no response or scale to rank by; "
+          f"keeping an evenly strided {k} of them")
+    return np.arange(k) * n // k
+
+
+def knn2_bruteforce(desc_a, desc_b):
+    """
+    Exact 2-nearest-neighbour search by L2 distance.
+    
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b so each block of rows is one SGEMM.
+    
+    Returns:
+        (train_idx, dist): (N, 2) int64 indices into desc_b and (N, 2) float32 L2 distances,
+        nearest first
+    """
+    n = len(desc_a)
+    sq_b = np.einsum('ij,ij->i', desc_b, desc_b)
+    train_idx = np.empty((n, 2), dtype=np.int64)
+    dist_sq = np.empty((n, 2), dtype=np.float32)
+    
+    block = max(1, BRUTE_FORCE_BLOCK_ELEMS // len(desc_b))
+    for start in range(0, n, block):
+        a = desc_a[start:start + block]
+        d2 = a @ desc_b.T
+        d2 *= -2
+        d2 += np.einsum('ij,ij->i', a, a)[:, None]
+        d2 += sq_b
+        
+        top2 = np.argpartition(d2, 1, axis=1)[:, :2]
+        top2_d2 = np.take_along_axis(d2, top2, axis=1)
+        swap = top2_d2[:, 0] > top2_d2[:, 1]
+        top2[swap] = top2[swap, ::-1]
+        top2_d2[swap] = top2_d2[swap, ::-1]
+        
+        train_idx[start:start + block] = top2
+        dist_sq[start:start + block] = top2_d2
+    
+    return train_idx, np.sqrt(np.maximum(dist_sq, 0, out=dist_sq))
+
+
+def knn_arrays(knn_matches, k):
+    """
+    Flatten cv2 knnMatch output into arrays, dropping rows with fewer than k neighbours.
+    
+    Returns:
+        (query_idx, train_idx, dist): (N,) int64, (N, k) int64 and (N, k) float32
+    """
+    rows = [r for r in knn_matches if len(r) >= k]
+    n = len(rows)
+    query_idx = np.fromiter((r[0].queryIdx for r in rows), np.int64, n)
+    train_idx = np.fromiter((r[i].trainIdx for r in rows for i in range(k)), np.int64, n * k).reshape(n, k)
+    dist = np.fromiter((r[i].distance for r in rows for i in range(k)), np.float32, n * k).reshape(n, k)
+    return query_idx, train_idx, dist
+
+
+def keypoint_xy(keypoints):
+    """(N, 2) float64 array of packed keypoint coordinates"""
+    return np.column_stack((keypoints['x'], keypoints['y']))
+
+
+def build_matches(xy_a, xy_b, idx_a, idx_b, distance):
+    """Response match dicts for matched index arrays"""
+    return [
+        {
+            "idx_a": ia,
+            "idx_b": ib,
+            "distance": d,
+            "pt_a": {"x": pa[0], "y": pa[1]},
+            "pt_b": {"x": pb[0], "y": pb[1]}
+        }
+        for ia, ib, d, pa, pb in zip(idx_a.tolist(), idx_b.tolist(), distance.tolist(),
+                                     xy_a[idx_a].tolist(), xy_b[idx_b].tolist())
+    ]
+
+
+# Record layout of binary match payloads (little-endian, 28 bytes per match)
+MATCH_DTYPE = np.dtype([
+    ('idx_a', '<i4'), ('idx_b', '<i4'), ('distance', '<f4'),
+    ('xa', '<f4'), ('ya', '<f4'), ('xb', '<f4'), ('yb', '<f4'),
+])
+
+
+def pack_matches(xy_a, xy_b, idx_a, idx_b, distance):
+    """
+    Binary form of build_matches: one MATCH_DTYPE record per match, base64 encoded.
+    
+    The client can decode it straight into typed arrays (every field is 4 bytes).
+    """
+    payload = np.empty(len(idx_a), dtype=MATCH_DTYPE)
+    payload['idx_a'] = idx_a
+    payload['idx_b'] = idx_b
+    payload['distance'] = distance
+    payload['xa'] = xy_a[idx_a, 0]
+    payload['ya'] = xy_a[idx_a, 1]
+    payload['xb'] = xy_b[idx_b, 0]
+    payload['yb'] = xy_b[idx_b, 1]
+    return {
+        "matches_b64": base64.b64encode(payload.tobytes()).decode('ascii'),
+        "dtype": [[name, MATCH_DTYPE[name].str] for name in MATCH_DTYPE.names],
+    }
+
+
+def _stereo_filter_loop(query_idx, train_idx, d1, d2, ys, ratio, y_tol):
+    """Mask of self-matches passing the ratio test (d1 < ratio * d2) that are within y_tol vertically"""
+    mask = np.zeros(len(query_idx), dtype=np.bool_)
+    for i in range(len(query_idx)):
+        if d1[i] < ratio * d2[i] and abs(ys[query_idx[i]] - ys[train_idx[i]]) < y_tol:
+            mask[i] = True
+    return mask
+
+def _stereo_filter_numpy(query_idx, train_idx, d1, d2, ys, ratio, y_tol):
+    """NumPy form of _stereo_filter_loop, for when numba is unavailable"""
+    return (d1 < ratio * d2) & (np.abs(ys[query_idx] - ys[train_idx]) < y_tol)
+
+# Compiled, the loop is a single fused pass with no intermediate arrays
+if HAS_NUMBA:
+    _stereo_filter = njit(cache=True)(_stereo_filter_loop)
+else:
+    _stereo_filter = _stereo_filter_numpy
+
+
+def flann_params(n):
+    """
+    FLANN KD-tree index/search parameters scaled to the size n of the indexed set.
+    
+    Small sets need few trees and leaf checks; large ones need more to keep recall up.
+    """
+    trees = 1 if n < 500 else 4 if n < 5000 else 8
+    checks = min(FLANN_MAX_CHECKS, int(16 * math.log2(max(n, 4))))
+    return dict(algorithm=FLANN_INDEX_KDTREE, trees=trees), dict(checks=checks)
+
 
 class SIFTMatcher:
     """FLANN-based matcher for SIFT descriptors"""
     
-    def __init__(self, ratio_threshold=0.75):
+    def __init__(self, ratio_threshold=0.8, max_keypoints=MAX_KEYPOINTS):
         self.ratio_threshold = ratio_threshold
-        
-        if HAS_OPENCV:
-            # FLANN parameters for SIFT (float descriptors)
-            FLANN_INDEX_KDTREE = 1
-            index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-            search_params = dict(checks=50)
-            self.flann = cv2.FlannBasedMatcher(index_params, search_params)
-        else:
-            self.flann = None
+        self.max_keypoints = max_keypoints
     
-    def match(self, keypoints_a, keypoints_b):
+    def match(self, keypoints_a, keypoints_b, descriptors_a=None, descriptors_b=None, binary=False):
         """
         Match keypoints between two images.
         
         Args:
-            keypoints_a: List of keypoint dicts from image A
-            keypoints_b: List of keypoint dicts from image B
+            keypoints_a: List of keypoint dicts from image A, or pack_keypoints output
+            keypoints_b: List of keypoint dicts from image B, or pack_keypoints output
+            descriptors_a: Optional base64 float32 or uint8 (N, 128) blob; replaces 'descriptor' in keypoints_a
+            descriptors_b: Optional base64 float32 or uint8 (M, 128) blob; replaces 'descriptor' in keypoints_b
+            binary: Return matches as a packed base64 payload ("matches_b64", see MATCH_DTYPE)
+                instead of a list of dicts
             
         Returns:
             List of match dicts with indices and distance
+        
+        Only the max_keypoints strongest keypoints of each image take part; returned
+        indices still refer to the full input lists.
         """
         if not HAS_OPENCV:
             return {"matches": [], "error": "OpenCV not installed"}
         
-        if not keypoints_a or not keypoints_b:
+        if len(keypoints_a) == 0 or len(keypoints_b) == 0:
             return {"matches": [], "error": "Empty keypoint list"}
         
-        # Extract descriptors as numpy arrays
+        # Extract descriptors and coordinates as numpy arrays
         try:
-            desc_a = np.array([kp['descriptor'] for kp in keypoints_a], dtype=np.float32)
-            desc_b = np.array([kp['descriptor'] for kp in keypoints_b], dtype=np.float32)
-        except (KeyError, TypeError) as e:
+            if not isinstance(keypoints_a, np.ndarray):
+                keypoints_a = pack_keypoints(keypoints_a, with_descriptors=descriptors_a is None)
+            if not isinstance(keypoints_b, np.ndarray):
+                keypoints_b = pack_keypoints(keypoints_b, with_descriptors=descriptors_b is None)
+            desc_a = extract_descriptors(keypoints_a, descriptors_a)
+            desc_b = extract_descriptors(keypoints_b, descriptors_b)
+            xy_a = keypoint_xy(keypoints_a)
+            xy_b = keypoint_xy(keypoints_b)
+        except (KeyError, TypeError, ValueError) as e:
             return {"matches": [], "error": f"Invalid descriptor format: {e}"}
         
         if len(desc_a) < 2 or len(desc_b) < 2:
             return {"matches": [], "error": "Need at least 2 keypoints per image"}
         
-        # Perform KNN matching (k=2 for ratio test)
-        try:
-            matches = self.flann.knnMatch(desc_a, desc_b, k=2)
-        except cv2.error as e:
-            return {"matches": [], "error": f"FLANN error: {e}"}
+        # Bound matching cost by keeping only the strongest keypoints
+        sel_a = strongest_keypoints(keypoints_a, self.max_keypoints)
+        sel_b = strongest_keypoints(keypoints_b, self.max_keypoints)
+        if sel_a is not None:
+            desc_a = desc_a[sel_a]
+        if sel_b is not None:
+            desc_b = desc_b[sel_b]
+        
+        # KNN matching (k=2 for ratio test)
+        if len(desc_a) * len(desc_b) < BRUTE_FORCE_MAX_PAIRS:
+            train_idx, dist = knn2_bruteforce(desc_a, desc_b)
+            query_idx = np.arange(len(desc_a))
+        else:
+            try:
+                matches = cv2.FlannBasedMatcher(*flann_params(len(desc_b))).knnMatch(desc_a, desc_b, k=2)
+            except cv2.error as e:
+                return {"matches": [], "error": f"FLANN error: {e}"}
+            query_idx, train_idx, dist = knn_arrays(matches, 2)
         
         # Apply Lowe's ratio test
-        good_matches = []
-        for match_pair in matches:
-            if len(match_pair) == 2:
-                m, n = match_pair
-                if m.distance < self.ratio_threshold * n.distance:
-                    good_matches.append({
-                        "idx_a": m.queryIdx,
-                        "idx_b": m.trainIdx,
-                        "distance": float(m.distance),
-                        "pt_a": {
-                            "x": keypoints_a[m.queryIdx]['x'],
-                            "y": keypoints_a[m.queryIdx]['y']
-                        },
-                        "pt_b": {
-                            "x": keypoints_b[m.trainIdx]['x'],
-                            "y": keypoints_b[m.trainIdx]['y']
-                        }
-                    })
-        
-        return {
-            "matches": good_matches,
-            "count": len(good_matches),
+        keep = dist[:, 0] < self.ratio_threshold * dist[:, 1]
+        idx_a, idx_b, distance = query_idx[keep], train_idx[keep, 0], dist[keep, 0]
+        if sel_a is not None:
+            idx_a = sel_a[idx_a]
+        if sel_b is not None:
+            idx_b = sel_b[idx_b]
+        
+        if binary:
+            result = pack_matches(xy_a, xy_b, idx_a, idx_b, distance)
+        else:
+            result = {"matches": build_matches(xy_a, xy_b, idx_a, idx_b, distance)}
+        
+        result.update({
+            "count": len(idx_a),
             "total_a": len(keypoints_a),
             "total_b": len(keypoints_b)
-        }
+        })
+        return result
     
-    def match_self(self, keypoints):
+    def match_self(self, keypoints, descriptors=None, binary=False):
         """
         Match keypoints to themselves (for stereo pair detection).
         Useful when left and right views are in the same image.
         
+        descriptors: Optional base64 float32 or uint8 (N, 128) blob; replaces 'descriptor' in keypoints
+        binary: Return matches as a packed base64 payload (see match)
+        
+        keypoints may be a list of keypoint dicts or pack_keypoints output.
+        
+        Only the 2 * max_keypoints strongest keypoints take part; returned indices still
+        refer to the full input list.
+        
         Returns matches excluding self-matches.
         """
         if not HAS_OPENCV:
             return {"matches": [], "error": "OpenCV not installed"}
         
-        if not keypoints or len(keypoints) < 4:
+        if keypoints is None or len(keypoints) < 4:
             return {"matches": [], "error": "Need at least 4 keypoints"}
         
-        desc = np.array([kp['descriptor'] for kp in keypoints], dtype=np.float32)
+        try:
+            if not isinstance(keypoints, np.ndarray):
+                keypoints = pack_keypoints(keypoints, with_descriptors=descriptors is None)
+            desc = extract_descriptors(keypoints, descriptors)
+            xy = keypoint_xy(keypoints)
+        except (KeyError, TypeError, ValueError) as e:
+            return {"matches": [], "error": f"Invalid descriptor format: {e}"}
+        
+        # Bound matching cost as in match; both views share this one keypoint list
+        sel = strongest_keypoints(keypoints, 2 * self.max_keypoints)
+        ys = xy[:, 1]
+        if sel is not None:
+            desc = desc[sel]
+            ys = ys[sel]
         
         # KNN with k=3 to skip self-match
-        matches = self.flann.knnMatch(desc, desc, k=3)
-        
-        good_matches = []
-        for match_triple in matches:
-            if len(match_triple) >= 3:
-                # Skip first match (self), apply ratio test on 2nd and 3rd
-                m, n = match_triple[1], match_triple[2]
-                if m.distance < self.ratio_threshold * n.distance:
-                    # Additional filter: matches should be horizontally aligned (stereo)
-                    pt_a = keypoints[m.queryIdx]
-                    pt_b = keypoints[m.trainIdx]
-                    
-                    # Check vertical alignment (within 10% of image height tolerance)
-                    y_diff = abs(pt_a['y'] - pt_b['y'])
-                    if y_diff < 50:  # Adjust threshold as needed
-                        good_matches.append({
-                            "idx_a": m.queryIdx,
-                            "idx_b": m.trainIdx,
-                            "distance": float(m.distance),
-                            "pt_a": {"x": pt_a['x'], "y": pt_a['y']},
-                            "pt_b": {"x": pt_b['x'], "y": pt_b['y']}
-                        })
-        
-        return {
-            "matches": good_matches,
-            "count": len(good_matches),
+        matches = cv2.FlannBasedMatcher(*flann_params(len(desc))).knnMatch(desc, desc, k=3)
+        query_idx, train_idx, dist = knn_arrays(matches, 3)
+        
+        # Skip first match (self), apply ratio test on 2nd and 3rd
+        # Additional filter: matches should be horizontally aligned (stereo)
+        # Check vertical alignment (within 10% of image height tolerance)
+        train_idx = train_idx[:, 1]
+        keep = _stereo_filter(query_idx, train_idx, dist[:, 1].copy(), dist[:, 2].copy(),
+                             np.ascontiguousarray(ys), self.ratio_threshold,
+                             50.0)  # Adjust threshold as needed
+        
+        idx_a, idx_b, distance = query_idx[keep], train_idx[keep], dist[keep, 1]
+        if sel is not None:
+            idx_a = sel[idx_a]
+            idx_b = sel[idx_b]
+        
+        if binary:
+            result = pack_matches(xy, xy, idx_a, idx_b, distance)
+        else:
+            result = {"matches": build_matches(xy, xy, idx_a, idx_b, distance)}
+        
+        result.update({
+            "count": len(idx_a),
             "total": len(keypoints)
-        }
+        })
+        return result
 
 
 # Singleton instance
 _matcher = None
+_matcher_lock = threading.Lock()
 
 def get_matcher():
     global _matcher
     if _matcher is None:
-        _matcher = SIFTMatcher()
+        with _matcher_lock:
+            if _matcher is None:
+                _matcher = SIFTMatcher()
     return _matcher
@@ -4,21 +4,131 @@ Simple HTTP server for WebGPU SIFT application.
 Serves static files and provides a /match endpoint for feature matching.
 """
 
+import binascii
+import gzip
 import http.server
-import socketserver
 import json
 import os
 import sys
 import threading
+import time
+
+import numpy as np
+
+# Fast JSON (orjson) when installed; orjson.JSONDecodeError subclasses json.JSONDecodeError
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 # Add parent directory to path to allow importing from demos
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from matcher import get_matcher
+from matcher import get_matcher, pack_keypoints, HAS_OPENCV
 from demos.wigglegram import create_wigglegram
 
+if HAS_OPENCV:
+    import cv2
+
 PORT = 8000
 
+# cv::CPU_AVX2 (not exported by the Python bindings)
+CV_CPU_AVX2 = 11
+
+# Shared SIFT detector for /detect (avoids re-allocating its pyramid workspace per
+# request); OpenCV's SIFT isn't guaranteed thread-safe, so calls are serialized
+_SIFT = cv2.SIFT_create() if HAS_OPENCV else None
+_SIFT_LOCK = threading.Lock()
+
+# Largest accepted POST body; Content-Length is client-supplied and _read_body
+# allocates it up front
+MAX_BODY_BYTES = 64 << 20
+
+# JSON responses larger than this are gzip-compressed for clients that accept it
+GZIP_MIN_BYTES = 4096
+
+# Static-file existence checks in do_GET are cached briefly: {path: (checked_at, exists)}
+STAT_CACHE_TTL = 1.0
+STAT_CACHE_MAX_ENTRIES = 1024
+_stat_cache = {}
+
+
+def _path_exists(path):
+    """os.path.exists with results cached for STAT_CACHE_TTL seconds"""
+    now = time.monotonic()
+    entry = _stat_cache.get(path)
+    if entry is not None and now - entry[0] < STAT_CACHE_TTL:
+        return entry[1]
+    exists = os.path.exists(path)
+    if len(_stat_cache) >= STAT_CACHE_MAX_ENTRIES:
+        # Request paths are client-controlled; don't let the cache grow without bound
+        _stat_cache.clear()
+    _stat_cache[path] = (now, exists)
+    return exists
+
+# Content types accepted as a raw image body on /detect
+RAW_IMAGE_TYPES = ('application/octet-stream', 'image/')
+
+# Quantization scale for unit-norm descriptors, as in the WebGPU quantized descriptor shader
+DESC_SCALE = 512
+
+
+def rootsift_uint8(descriptors):
+    """
+    RootSIFT descriptors quantized to uint8.
+    
+    L1-normalize and take the square root (unit L2 norm, Hellinger kernel), then
+    scale by DESC_SCALE and saturate to 0..255.
+    """
+    desc = descriptors / (descriptors.sum(axis=1, keepdims=True) + 1e-7)
+    np.sqrt(desc, out=desc)
+    desc *= DESC_SCALE
+    return np.clip(desc, 0, 255).astype(np.uint8)
+
+
+def _accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header value allows gzip (honouring q=0 and '*')"""
+    wildcard = None
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ('gzip', 'x-gzip'):
+            return q > 0
+        if coding == '*':
+            wildcard = q > 0
+    return bool(wildcard)
+
+def _read_body(rfile, n, chunk=1 << 20):
+    """
+    Read an n-byte request body into a single preallocated bytearray.
+    
+    Reads at most chunk bytes per call straight into the buffer, so large uploads
+    never exist as an intermediate bytes object. Truncated if the client disconnects early.
+    """
+    buf = bytearray(n)
+    off = 0
+    with memoryview(buf) as mv:
+        while off < n:
+            r = rfile.readinto(mv[off:min(off + chunk, n)])
+            if not r:
+                break
+            off += r
+    if off < n:
+        del buf[off:]
+    return buf
+
 class SIFTHandler(http.server.SimpleHTTPRequestHandler):
     """HTTP handler with CORS and matching endpoint"""
     
@@ -47,7 +157,7 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
         else:
             # Check if file exists (custom 404)
             path = self.translate_path(self.path)
-            if not os.path.exists(path) and not self.path.startswith(('/match', '/detect', '/wigglegram')): 
+            if not _path_exists(path) and not self.path.startswith(('/match', '/detect', '/wigglegram')): 
                 # Note: POST endpoints might come here if Method is wrong, but this is DO_GET. 
                 # Pure static file check.
                 self.send_error(404, f"File not found: {self.path}")
@@ -56,6 +166,29 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
                 
             super().do_GET()
     
+    def read_body(self):
+        """
+        Read the request body, or reply with an error and return None if Content-Length
+        is missing, invalid or above MAX_BODY_BYTES.
+        """
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self.send_json_response({"error": "Missing or invalid Content-Length"}, status=411)
+            return None
+        if content_length < 0:
+            self.close_connection = True
+            self.send_json_response({"error": "Invalid Content-Length"}, status=400)
+            return None
+        if content_length > MAX_BODY_BYTES:
+            # The body is left unread, so the connection can't be reused
+            self.close_connection = True
+            self.send_json_response({"error": f"Request body too large (max {MAX_BODY_BYTES} bytes)"},
+                                    status=413)
+            return None
+        return _read_body(self.rfile, content_length)
+    
     def do_POST(self):
         if self.path == '/match':
             self.handle_match()
@@ -71,26 +204,35 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
     def handle_detect(self):
         """Handle SIFT detection request"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
+            post_data = self.read_body()
+            if post_data is None:
+                return
             
-            # Parse JSON
-            data = json.loads(post_data)
-            image_data = data.get('image') # Base64 string
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith(RAW_IMAGE_TYPES):
+                # Raw encoded image (JPEG/PNG bytes) as the body: no base64 or JSON work
+                img_bytes = post_data
+            else:
+                # Parse JSON
+                data = _loads(post_data)
+                image_data = data.get('image') # Base64 string, optionally a data URL
+                
+                if not image_data:
+                    self.send_json_response({"error": "No image provided"}, status=400)
+                    return
+                
+                # Strip a data URL prefix; only the short header can contain the comma
+                comma = image_data.find(',', 0, 256)
+                if comma >= 0:
+                    image_data = image_data[comma + 1:]
+                
+                img_bytes = binascii.a2b_base64(image_data)
             
-            if not image_data:
+            if not img_bytes:
                 self.send_json_response({"error": "No image provided"}, status=400)
                 return
-
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            import base64
-            import numpy as np
-            import cv2
             
             # Decode image
-            img_bytes = base64.b64decode(image_data)
             nparr = np.frombuffer(img_bytes, np.uint8)
             img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
             
@@ -99,14 +241,15 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
                 return
 
             # Run SIFT
-            sift = cv2.SIFT_create()
-            keypoints, descriptors = sift.detectAndCompute(img, None)
+            with _SIFT_LOCK:
+                keypoints, descriptors = _SIFT.detectAndCompute(img, None)
             
-            # Format results
+            # Format results; descriptors ship as RootSIFT uint8 (integers, 4x smaller than float32)
             results = []
             if keypoints is not None:
+                descs = rootsift_uint8(descriptors).tolist() if descriptors is not None else None
                 for i, kp in enumerate(keypoints):
-                    desc = descriptors[i].tolist() if descriptors is not None else []
+                    desc = descs[i] if descs is not None else []
                     results.append({
                         "x": float(kp.pt[0]),
                         "y": float(kp.pt[1]),
@@ -129,15 +272,25 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
     def handle_match(self):
         """Handle single-image self-matching (for stereo pairs)"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data)
+            post_data = self.read_body()
+            if post_data is None:
+                return
+            data = _loads(post_data)
             
             keypoints = data.get('keypoints', [])
+            descriptors = data.get('descriptors')
             print(f"[Match] Received {len(keypoints)} keypoints for self-matching")
             
+            # Convert the keypoint dicts to arrays once, up front
+            try:
+                keypoints = pack_keypoints(keypoints, with_descriptors=descriptors is None)
+            except (KeyError, TypeError, ValueError) as e:
+                self.send_json_response({"matches": [], "error": f"Invalid keypoints: {e}"}, status=400)
+                return
+            
             matcher = get_matcher()
-            result = matcher.match_self(keypoints)
+            result = matcher.match_self(keypoints, descriptors=descriptors,
+                                        binary=bool(data.get('binary', False)))
             
             print(f"[Match] Found {result.get('count', 0)} matches")
             
@@ -152,16 +305,30 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
     def handle_match_pair(self):
         """Handle two-image matching"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data)
+            post_data = self.read_body()
+            if post_data is None:
+                return
+            data = _loads(post_data)
             
             keypoints_a = data.get('keypoints_a', [])
             keypoints_b = data.get('keypoints_b', [])
+            descriptors_a = data.get('descriptors_a')
+            descriptors_b = data.get('descriptors_b')
             print(f"[Match Pair] Received {len(keypoints_a)} + {len(keypoints_b)} keypoints")
             
+            # Convert the keypoint dicts to arrays once, up front
+            try:
+                keypoints_a = pack_keypoints(keypoints_a, with_descriptors=descriptors_a is None)
+                keypoints_b = pack_keypoints(keypoints_b, with_descriptors=descriptors_b is None)
+            except (KeyError, TypeError, ValueError) as e:
+                self.send_json_response({"matches": [], "error": f"Invalid keypoints: {e}"}, status=400)
+                return
+            
             matcher = get_matcher()
-            result = matcher.match(keypoints_a, keypoints_b)
+            result = matcher.match(keypoints_a, keypoints_b,
+                                   descriptors_a=descriptors_a,
+                                   descriptors_b=descriptors_b,
+                                   binary=bool(data.get('binary', False)))
             
             print(f"[Match Pair] Found {result.get('count', 0)} matches")
             
@@ -176,11 +343,12 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
     def handle_wigglegram(self):
         """Handle wigglegram generation request"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
+            post_data = self.read_body()
+            if post_data is None:
+                return
             
             # Use strict=False for control characters in base64 if needed
-            data = json.loads(post_data)
+            data = _loads(post_data)
             
             img_a = data.get('image_a')
             img_b = data.get('image_b')
@@ -215,11 +383,20 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json_response({"error": str(e)}, status=500)
 
     def send_json_response(self, data, status=200):
-        """Send a JSON response"""
+        """Send a JSON response, gzip-compressed if large and the client accepts it"""
+        body = _dumps(data)
         self.send_response(status)
         self.send_header('Content-Type', 'application/json')
+        if len(body) > GZIP_MIN_BYTES:
+            # The encoding depends on the request, so caches must key on Accept-Encoding
+            self.send_header('Vary', 'Accept-Encoding')
+            if _accepts_gzip(self.headers.get('Accept-Encoding', '')):
+                # Level 1: nearly all of the size win on repetitive JSON for little CPU
+                body = gzip.compress(body, compresslevel=1)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(body)
     
     def log_message(self, format, *args):
         """Custom logging format"""
@@ -233,6 +410,35 @@ class SIFTHandler(http.server.SimpleHTTPRequestHandler):
             print(f"[Server] {args[0]}")
 
 
+def log_cpu_dispatch():
+    """
+    Log the SIMD paths OpenCV will use and warn if AVX2 is available but unused.
+    
+    In the features line, plain entries are the build's baseline, a '*' prefix marks
+    runtime-dispatched code and a '?' suffix code this CPU (or setUseOptimized) disables.
+    """
+    if not HAS_OPENCV:
+        return
+    features = cv2.getCPUFeaturesLine()
+    print(f"[Server] OpenCV {cv2.__version__} CPU features: {features}")
+    build_info = cv2.getBuildInformation()
+    start = build_info.find('CPU/HW features')
+    if start >= 0:
+        for line in build_info[start:].splitlines()[1:]:
+            if not line.startswith('    '):
+                break
+            if line.strip().startswith(('Baseline', 'Dispatched')):
+                print(f"[Server]   {line.strip()}")
+    
+    if not cv2.useOptimized():
+        print("[Server] Warning: OpenCV optimizations are disabled (cv2.setUseOptimized(False)); "
+              "SIFT will run without SIMD dispatch.")
+    elif cv2.checkHardwareSupport(CV_CPU_AVX2) and 'AVX2' not in features.replace('*', '').split():
+        print("[Server] Warning: this CPU supports AVX2 but OpenCV is not using it; SIFT will run "
+              "on narrower SIMD paths. Install a current opencv-python-headless wheel or build "
+              "with -DCPU_DISPATCH=AVX2 (or -DCPU_BASELINE=AVX2).")
+
+
 def main():
     print(f"""
 ╔═══════════════════════════════════════════╗
@@ -250,11 +456,13 @@ def main():
 ║  Press Ctrl+C or visit /stop to stop     ║
 ╚═══════════════════════════════════════════╝
 """)
+    log_cpu_dispatch()
     
     # Allow socket reuse
-    socketserver.TCPServer.allow_reuse_address = True
+    http.server.ThreadingHTTPServer.allow_reuse_address = True
     
-    with socketserver.TCPServer(("", PORT), SIFTHandler) as httpd:
+    # One thread per request so a slow /wigglegram doesn't block /detect or static files
+    with http.server.ThreadingHTTPServer(("", PORT), SIFTHandler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -4,6 +4,7 @@ import cv2
 print("cv2 imported")
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 def rotate_image(image, angle):
     image_center = tuple(np.array(image.shape[1::-1]) / 2)
@@ -18,6 +19,45 @@ def rotate_image(image, angle):
     result = cv2.warpAffine(image, rot_mat, (bound_w, bound_h), flags=cv2.INTER_LINEAR)
     return result
 
+# Reference image and features, set once per worker process by init_worker
+_ref = None
+
+def init_worker(img_bytes, shape, des1_bytes, kp1_pts):
+    global _ref
+    # One OpenCV thread per process; the pool already keeps every core busy
+    cv2.setNumThreads(1)
+    img = np.frombuffer(img_bytes, dtype=np.uint8).reshape(shape)
+    des1 = np.frombuffer(des1_bytes, dtype=np.float32).reshape(-1, 128)
+    _ref = (img, des1, kp1_pts, cv2.SIFT_create(), cv2.BFMatcher())
+
+def eval_angle(angle):
+    img, des1, kp1_pts, sift, bf = _ref
+    # Rotate
+    img_rot = rotate_image(img, angle)
+    
+    # Detect
+    kp2, des2 = sift.detectAndCompute(img_rot, None)
+    
+    val = 0
+    if des2 is not None and len(kp2) >= 4:
+        # Match
+        matches = bf.knnMatch(des1, des2, k=2)
+        
+        # Lowe's ratio test
+        good_matches = [m for m, n in matches if m.distance < 0.75 * n.distance]
+
+        if len(good_matches) >= 4:
+            # RANSAC
+            kp2_pts = np.float32([kp.pt for kp in kp2])
+            src_pts = kp1_pts[[m.queryIdx for m in good_matches]].reshape(-1, 1, 2)
+            dst_pts = kp2_pts[[m.trainIdx for m in good_matches]].reshape(-1, 1, 2)
+
+            M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+            
+            if mask is not None:
+                val = int(np.sum(mask))
+    return val
+
 def run_test():
     print("Inside run_test")
     img_path = 'demo/book2.jpg'
@@ -41,42 +81,17 @@ def run_test():
     print(f"Reference keypoints: {len(kp1)}")
 
     angles = list(range(-180, 185, 5))
-    inliers_counts = []
-
-    # Matcher
-    bf = cv2.BFMatcher()
+    kp1_pts = np.float32([kp.pt for kp in kp1])
     
     print("Angle,Inliers")
 
-    for angle in angles:
-        # Rotate
-        img_rot = rotate_image(img, angle)
-        
-        # Detect
-        kp2, des2 = sift.detectAndCompute(img_rot, None)
-        
-        val = 0
-        if des2 is not None and len(kp2) >= 4:
-            # Match
-            matches = bf.knnMatch(des1, des2, k=2)
-            
-            # Lowe's ratio test
-            good_matches = []
-            for m, n in matches:
-                if m.distance < 0.75 * n.distance:
-                    good_matches.append(m)
-
-            if len(good_matches) >= 4:
-                # RANSAC
-                src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-                dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+    # Each angle is independent: sweep them across processes, shipping the reference
+    # image and features to each worker once as raw bytes
+    init_args = (img.tobytes(), img.shape, np.ascontiguousarray(des1, dtype=np.float32).tobytes(), kp1_pts)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker, initargs=init_args) as ex:
+        inliers_counts = list(ex.map(eval_angle, angles, chunksize=4))
 
-                M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
-                
-                if mask is not None:
-                    val = np.sum(mask)
-        
-        inliers_counts.append(val)
+    for angle, val in zip(angles, inliers_counts):
         print(f"{angle},{val}")
 
     # Stats